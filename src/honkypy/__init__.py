@@ -29,15 +29,19 @@ routines written in pure Python.
 
 import collections.abc
 import io
+import mmap
+import os
 
-from .dctx import DecrypterContext, Version1Context, Version2Context, setup_v3
+from .dctx import DecrypterContext, Version1Context, Version2Context, header_matches_v3, setup_v3
 from .error import *
 from .key_tables import *
+from .util import _CHUNK_SIZE, calculate_md5
 
-from typing import Callable, Literal, IO, cast
+from typing import Callable, Literal, IO, Sequence, cast
 
 
-_SupportsDctxType = Callable[[bytes, bytes, list[int] | None, bytes | None], DecrypterContext]
+_SupportsDctxType = Callable[[bytes, bytes, Sequence[int] | None, bytes | None], DecrypterContext]
+_HeaderMatchesType = Callable[[bytes, bytes, Sequence[int] | None, bytes], bool]
 _ValidGametypes = Literal["JP", "WW", "TW", "CN"]
 
 
@@ -48,16 +52,35 @@ NAME_PREFIX_CN = b"iLbs0LpvJrXm3zjdhAr4"
 NAME_PREFIX_EN = NAME_PREFIX_WW
 
 
-_COMBINATION: list[tuple[_ValidGametypes, bytes, list[int]]] = [
+_COMBINATION: tuple[tuple[_ValidGametypes, bytes, Sequence[int]], ...] = (
     ("JP", NAME_PREFIX_JP, KEY_TABLES_JP),
     ("WW", NAME_PREFIX_WW, KEY_TABLES_WW),
     ("TW", NAME_PREFIX_TW, KEY_TABLES_TW),
     ("CN", NAME_PREFIX_CN, KEY_TABLES_CN),
-]
+)
 
-_GAME_VERSIONS: list[_SupportsDctxType] = [Version1Context, Version2Context, setup_v3, setup_v3]
+_COMBINATION_BY_GAMETYPE_CF: dict[str, tuple[bytes, Sequence[int]]] = {
+    gt.casefold(): (prefix, key_tables) for gt, prefix, key_tables in _COMBINATION
+}
 
-_GAME_VERSIONS_PROBE: list[_SupportsDctxType] = [Version2Context, setup_v3, setup_v3]
+_GAME_VERSIONS: tuple[_SupportsDctxType, ...] = (Version1Context, Version2Context, setup_v3, setup_v3)
+
+_GAME_VERSIONS_PROBE: tuple[tuple[_HeaderMatchesType, _SupportsDctxType], ...] = (
+    (Version2Context.header_matches, Version2Context),
+    (header_matches_v3, setup_v3),
+)
+
+
+def _probe_combination(filename: bytes, header: bytes) -> tuple[_ValidGametypes, bytes, Sequence[int]] | None:
+    # V2 header starts with digest[4:7] and V3+ header starts with its complement, so XOR-ing the header
+    # against the digest gives either all zero or all one bits for the right game type.
+    value = int.from_bytes(header[:3], "big")
+    for combination in _COMBINATION:
+        digest, _ = calculate_md5(combination[1], filename)
+        diff = value ^ int.from_bytes(digest[4:7], "big")
+        if diff == 0 or diff == 0xFFFFFF:
+            return combination
+    return None
 
 
 def decrypt_setup_probe(
@@ -76,6 +99,23 @@ def decrypt_setup_probe(
     Returns:
         tuple[DecrypterContext, _ValidGametypes]: Newly decrypter context and the game type string.
     """
+    if len(header) < 16:
+        # Every mode needs the full header, don't hash the filename for nothing.
+        raise NoSuitableModeError()
+    if isinstance(filename, str):
+        filename = filename.encode("UTF-8")
+    # Version 1 has no header to dispatch on.
+    if version != 1:
+        hit = _probe_combination(filename, header)
+        if hit is None:
+            # No game type produces this header for this file.
+            raise NoSuitableModeError()
+        gametype, prefix, key_tables = hit
+        try:
+            dctx = decrypt_setup(prefix, filename, header, key_tables, version)
+            return dctx, gametype
+        except ValueError:
+            pass
     # Try all combination
     for gametype, prefix, key_tables in _COMBINATION:
         try:
@@ -90,7 +130,7 @@ def decrypt_setup(
     prefix: bytes,
     filename: str | bytes,
     header: bytes,
-    key_tables: list[int],
+    key_tables: Sequence[int],
     version: int = 0,
 ) -> DecrypterContext:
     """Initialize decrypter with specified parameters.
@@ -99,7 +139,7 @@ def decrypt_setup(
         prefix (bytes): Game file prefix. Can be one of `NAME_PREFIX_*`
         filename (str | bytes): Name of the file. The basename is used to derive the key.
         header (bytes): First 16-byte of the file data.
-        key_tables (list[int]): Key tables with 64 elements used for V3 decryption. Can be one of `KEY_TABLES_*`.
+        key_tables (Sequence[int]): Key tables with 64 elements used for V3 decryption. Can be one of `KEY_TABLES_*`.
         version (int, optional): Specify decryption version, or 0 to automatically determine. Defaults to 0.
 
     Raises:
@@ -115,12 +155,13 @@ def decrypt_setup(
     if len(header) < 16:
         raise InsufficientHeaderDataError()
     if version == 0:
-        for context_class in _GAME_VERSIONS_PROBE:
-            try:
-                dctx = context_class(prefix, filename, key_tables, header)
-                return dctx
-            except ValueError:
-                pass
+        for header_matches, context_class in _GAME_VERSIONS_PROBE:
+            if header_matches(prefix, filename, key_tables, header):
+                try:
+                    dctx = context_class(prefix, filename, key_tables, header)
+                    return dctx
+                except ValueError:
+                    pass
         raise NoSuitableModeError()
     elif version < 0 or version > len(_GAME_VERSIONS):
         raise VersionOutOfRange()
@@ -136,7 +177,7 @@ def encrypt_setup(
     version: int,
     *,
     v3_flip_key: bool = False,
-    v3_key_tables: list[int] | None = None,
+    v3_key_tables: Sequence[int] | None = None,
     v4_lcg_index: int = 0,
 ) -> DecrypterContext:
     """Initialize decrypter context for encrypting.
@@ -146,7 +187,7 @@ def encrypt_setup(
         filename (str | bytes): Name of the file. The basename is used to derive the key.
         version (int): Specify decryption version.
         v3_flip_key (bool, optional): Whetever to flip the initial key in V3. Defaults to False.
-        v3_key_tables (list[int] | None, optional): Key tables with 64 elements used for V3 decryption. Defaults to None.
+        v3_key_tables (Sequence[int] | None, optional): Key tables with 64 elements used for V3 decryption. Defaults to None.
         v4_lcg_index (int, optional): Linear Congruential Generator key index for V4. Defaults to 0.
 
     Raises:
@@ -195,14 +236,61 @@ def encrypt_setup_by_gametype(
     Returns:
         DecrypterContext: Newly decrypter context.
     """
-    gametype_cf = gametype.casefold()
+    entry = _COMBINATION_BY_GAMETYPE_CF.get(gametype.casefold())
+    if entry is None:
+        raise InvalidGameType(gametype)
+    prefix, key_tables = entry
+    return encrypt_setup(
+        prefix, filename, version, v3_flip_key=v3_flip_key, v3_key_tables=key_tables, v4_lcg_index=v4_lcg_index
+    )
+
 
-    for gt, prefix, key_tables in _COMBINATION:
-        if gametype_cf == gt.casefold():
-            return encrypt_setup(
-                prefix, filename, version, v3_flip_key=v3_flip_key, v3_key_tables=key_tables, v4_lcg_index=v4_lcg_index
-            )
-    raise InvalidGameType(gametype)
+def decrypt_file(
+    input: str, output: str, *, basename: str | bytes | None = None, version: int = 0
+) -> tuple[DecrypterContext, _ValidGametypes]:
+    """Decrypt a whole game file into another file.
+
+    The input file is memory-mapped and decrypted one chunk at a time, so memory use stays bounded regardless of the file
+    size, and decrypted chunks are written from a background thread.
+
+    Args:
+        input (str): Path to the encrypted game file.
+        output (str): Path where the decrypted data is written. Must not be the same file as `input`.
+        basename (str | bytes | None, optional): Name used to derive the key. Defaults to None which uses `input`.
+        version (int, optional): Specify decryption version, or 0 to automatically determine. Defaults to 0.
+
+    Raises:
+        ValueError: When `output` is the same file as `input`.
+        NoSuitableModeError: When there's no suitable decryption method.
+
+    Returns:
+        tuple[DecrypterContext, _ValidGametypes]: Decrypter context used and the game type string.
+    """
+    # Only needed here, and it pulls in logging and threading.
+    import concurrent.futures
+
+    # Opening the output would truncate the input before it is read.
+    if os.path.exists(output) and os.path.samefile(input, output):
+        raise ValueError("Output must not be the same file as input")
+    with open(input, "rb") as f:
+        dctx, gametype = decrypt_setup_probe(basename or input, f.read(16), version=version)
+        size = os.fstat(f.fileno()).st_size
+        with open(output, "wb") as out:
+            if size > dctx.HEADER_SIZE:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    # Writes release the GIL, so write each chunk in the background while decrypting the next one.
+                    with memoryview(mm) as view, concurrent.futures.ThreadPoolExecutor(1) as writer:
+                        pending: concurrent.futures.Future[int] | None = None
+                        for pos in range(dctx.HEADER_SIZE, size, _CHUNK_SIZE):
+                            chunk = dctx.decrypt_block(view[pos : pos + _CHUNK_SIZE])
+                            if pending is not None:
+                                pending.result()
+                            pending = writer.submit(out.write, chunk)
+                        if pending is not None:
+                            pending.result()
+    return dctx, gametype
 
 
 class StreamIOWrapper(IO[bytes]):
@@ -213,7 +301,7 @@ class StreamIOWrapper(IO[bytes]):
         Args:
             stream (IO[bytes]): Bytes IO stream.
             dctx (DecrypterContext): Decrypter context.
-            write_header (bool, optional): When encrypting, set this to true to write header automatically just when opening for writing. Defaults to False.
+            write_header (bool, optional): When encrypting, set this to true to write header automatically just when opening for writing. The context is then rewound to the start of the data, which costs nothing for a freshly created context. Defaults to False.
         """
         self._stream = stream
         self._dctx = dctx
@@ -250,6 +338,12 @@ class StreamIOWrapper(IO[bytes]):
         data = self._stream.read(n)
         return self._dctx.decrypt_block(data)
 
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        view = memoryview(buffer).cast("B")
+        data = self._stream.read(len(view))
+        view[: len(data)] = self._dctx.decrypt_block(data)
+        return len(data)
+
     def readable(self) -> bool:
         return self._stream.readable()
 
@@ -259,7 +353,14 @@ class StreamIOWrapper(IO[bytes]):
 
     def readlines(self, hint: int = -1) -> list[bytes]:
         data = self._stream.readlines(hint)
-        return [self._dctx.decrypt_block(d) for d in data]
+        # Decrypt everything in one go, then cut it back at the original line lengths.
+        decrypted = self._dctx.decrypt_block(b"".join(data))
+        result: list[bytes] = []
+        pos = 0
+        for line in data:
+            result.append(decrypted[pos : pos + len(line)])
+            pos = pos + len(line)
+        return result
 
     def seek(self, offset: int, whence: int = 0) -> int:
         if whence == io.SEEK_SET:
@@ -295,7 +396,7 @@ class StreamIOWrapper(IO[bytes]):
         self._stream.__exit__(type, value, traceback)
 
     def __iter__(self) -> collections.abc.Iterator[bytes]:
-        return self._stream.__iter__()
+        return self
 
     def __next__(self) -> bytes:
-        return self._stream.__next__()
+        return self._dctx.decrypt_block(self._stream.__next__())
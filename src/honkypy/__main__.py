@@ -22,11 +22,22 @@
 
 import argparse
 import io
-import os.path
+import mmap
+import os
 
-from . import _COMBINATION, StreamIOWrapper, decrypt_setup_probe, encrypt_setup_by_gametype
+from . import (
+    _CHUNK_SIZE,
+    _COMBINATION,
+    DecrypterContext,
+    StreamIOWrapper,
+    decrypt_file,
+    decrypt_setup_probe,
+    encrypt_setup_by_gametype,
+)
 from .error import HonkyPyError
 
+from typing import IO
+
 
 def get_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -47,31 +58,79 @@ def get_args():
     return parser.parse_args()
 
 
+def _advise_sequential(f: io.BufferedIOBase):
+    if hasattr(os, "posix_fadvise"):
+        # Only a hint, and pipes reject it.
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def _copy_stream(src: IO[bytes], dst: IO[bytes]):
+    while chunk := src.read(_CHUNK_SIZE):
+        dst.write(chunk)
+
+
+def _decrypt_in_place(f: io.BufferedRandom, dctx: DecrypterContext):
+    # Decrypted data is shorter than the input by the header size, so writes always stay behind reads.
+    size = os.fstat(f.fileno()).st_size
+    if size > dctx.HEADER_SIZE:
+        with mmap.mmap(f.fileno(), 0) as mm, memoryview(mm) as view:
+            for pos in range(dctx.HEADER_SIZE, size, _CHUNK_SIZE):
+                chunk = dctx.decrypt_block(view[pos : pos + _CHUNK_SIZE])
+                view[pos - dctx.HEADER_SIZE : pos - dctx.HEADER_SIZE + len(chunk)] = chunk
+    f.truncate(max(size - dctx.HEADER_SIZE, 0))
+
+
+def _encrypt_in_place(f: io.BufferedRandom, dctx: DecrypterContext):
+    # Encrypted data is longer than the input by the header size, so hold back what would overwrite unread input.
+    pending = dctx.emit_header()
+    read_pos = 0
+    write_pos = 0
+    while True:
+        f.seek(read_pos, io.SEEK_SET)
+        chunk = f.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        read_pos = read_pos + len(chunk)
+        pending = pending + dctx.decrypt_block(chunk)
+        writable = read_pos - write_pos
+        f.seek(write_pos, io.SEEK_SET)
+        write_pos = write_pos + f.write(pending[:writable])
+        pending = pending[writable:]
+    f.seek(write_pos, io.SEEK_SET)
+    f.write(pending)
+
+
 def main_entry() -> int:
     args = get_args()
     basename = args.basename or os.path.basename(args.input)
+    output = args.output or args.input
+    in_place = os.path.exists(output) and os.path.samefile(args.input, output)
 
     if args.encrypt:
         dctx = encrypt_setup_by_gametype(args.encrypt, basename, args.version)
+        if in_place:
+            with open(args.input, "r+b") as f:
+                _encrypt_in_place(f, dctx)
+        else:
+            with open(args.input, "rb") as src, StreamIOWrapper(open(output, "wb"), dctx, True) as dst:
+                _advise_sequential(src)
+                _copy_stream(src, dst)
+    elif args.detect:
         with open(args.input, "rb") as f:
-            contents = f.read()
-
-        with StreamIOWrapper(open(args.output or args.input, "wb"), dctx, True) as f:
-            f.write(contents)
+            try:
+                dctx, _ = decrypt_setup_probe(basename, f.read(16))
+                return dctx.VERSION
+            except HonkyPyError:
+                return 0
+    elif in_place:
+        with open(args.input, "r+b") as f:
+            dctx, _ = decrypt_setup_probe(basename, f.read(16))
+            _decrypt_in_place(f, dctx)
     else:
-        with open(args.input, "rb") as f:
-            if args.detect:
-                try:
-                    dctx, _ = decrypt_setup_probe(args.input, f.read(16))
-                    return dctx.VERSION
-                except HonkyPyError:
-                    return 0
-            else:
-                dctx, _ = decrypt_setup_probe(args.input, f.read(16))
-                f.seek(dctx.HEADER_SIZE, io.SEEK_SET)
-                decrypted_data = dctx.decrypt_block(f.read())
-        with open(args.output or args.input, "wb") as f:
-            f.write(decrypted_data)
+        decrypt_file(args.input, output, basename=basename)
     return 0
 
 
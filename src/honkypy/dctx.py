@@ -20,10 +20,13 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import array
+import struct
+
 from .error import *
-from .util import calculate_md5
+from .util import _CHUNK_SIZE, calculate_md5, xor_bytes
 
-from typing import ClassVar, cast
+from typing import ClassVar, Sequence, cast
 
 
 __all__ = [
@@ -32,18 +35,144 @@ __all__ = [
     "Version2Context",
     "Version3Context",
     "Version4Context",
+    "header_matches_v3",
     "setup_v3",
 ]
 
 
+# Largest keystream period, in bits, that is worth generating once and sharing between contexts.
+_LCG_CYCLE_MAX_BITS = 16
+
+# Amount of 64-bit slots packed into one integer when generating long keystreams, for both LCG states and version 1
+# keys, and a one in each of these slots.
+_LCG_LANES = 1024
+_LANE_ONES = int.from_bytes(b"\x01\x00\x00\x00\x00\x00\x00\x00" * _LCG_LANES, "little")
+
+# Keystreams shorter than this are cheaper to generate one LCG state at a time than through lanes or a cycle table.
+_LCG_LANES_MIN_LENGTH = 128
+
+# Version 3 and 4 headers. Both start with complemented MD5 bytes 4-6 and 12, followed by the flip flag and name sum
+# for version 3, or by the LCG index and 2 for version 4.
+_V3_HEADER = struct.Struct(">BBBB3xBI4x")
+_V4_HEADER = struct.Struct(">BBBB2xBB8x")
+
+# Version 1 keys packed into 64-bit slots: slot indices, and the low 32 bits of each slot.
+_V1_LANE_INDEX = int.from_bytes(struct.pack(f"<{_LCG_LANES}Q", *range(_LCG_LANES)), "little")
+_V1_LANE_MASK = 0xFFFFFFFF * _LANE_ONES
+
+# Version 1 keystreams with fewer 4-byte groups than this are cheaper to pack one key at a time.
+_V1_LANES_MIN_COUNT = 64
+
+# Amount of version 2 states packed at a time, so memory use is bounded by this rather than by the keystream length.
+_V2_BATCH_STATES = 4096
+
+
 class _LCGKeys:
     def __init__(self, a: int, c: int, s: int):
         self.a = a
         self.c = c
-        self.shift = s
+        # Shift is applied to 32-bit states, so only its low 5 bits matter.
+        self.shift = s & 0x1F
+        self._cycle: tuple[bytes, array.array[int]] | None = None
+        self._lanes: tuple[int, int, int, int, int, int] | None = None
+        # Step x -> a * x + c composed with itself 2^i times, for i from 0 to 31.
+        self._doublings: list[tuple[int, int]] = []
+        for i in range(32):
+            self._doublings.append((a, c))
+            c = (c * (a + 1)) & 0xFFFFFFFF
+            a = (a * a) & 0xFFFFFFFF
+
+    def advance(self, x: int, n: int):
+        # Compose x -> a * x + c with itself n times from the precomputed 2^i-fold steps. Every LCG here has a full
+        # period of 2^32, so only the low 32 bits of n matter.
+        mul = 1
+        add = 0
+        for a, c in self._doublings:
+            if n & 1:
+                mul = (mul * a) & 0xFFFFFFFF
+                add = (add * a + c) & 0xFFFFFFFF
+            n = n >> 1
+            if n == 0:
+                break
+        return (x * mul + add) & 0xFFFFFFFF
+
+    def keystream(self, x: int, length: int) -> tuple[bytes, int]:
+        """Generate keystream bytes starting from state `x`.
+
+        Args:
+            x (int): Current LCG state.
+            length (int): Amount of keystream bytes to generate.
 
-    def next(self, x: int):
-        return (x * self.a + self.c) & 0xFFFFFFFF
+        Returns:
+            tuple[bytes, int]: The keystream and the LCG state after it.
+        """
+        shift = self.shift
+        if length == 0:
+            return b"", x
+        if length < _LCG_LANES_MIN_LENGTH:
+            a = self.a
+            c = self.c
+            stream = bytearray(length)
+            for i in range(length):
+                stream[i] = (x >> shift) & 0xFF
+                x = (x * a + c) & 0xFFFFFFFF
+            return bytes(stream), x
+
+        if shift + 8 <= _LCG_CYCLE_MAX_BITS:
+            # Keystream bytes only depend on the low `shift + 8` bits of the state, which repeat on their own.
+            cycle, position = self._get_cycle()
+            start = position[x & ((1 << (shift + 8)) - 1)]
+            stream = (cycle * ((start + length) // len(cycle) + 1))[start : start + length]
+            return stream, self.advance(x, length)
+
+        # Run interleaved lanes packed into 64-bit slots of one integer, lane i producing bytes i, i + lanes, ...
+        # One multiply-add then advances every lane at once. Products of two 32-bit values plus a 32-bit
+        # increment never exceed 64 bits, so the slots never carry into each other.
+        lane_a, lane_c, jump_a, jump_c, state_mask, byte_mask = self._get_lanes()
+        packed = (x * lane_a + lane_c) & state_mask
+        chunks: list[bytes] = []
+        for i in range((length + _LCG_LANES - 1) // _LCG_LANES):
+            chunks.append(((packed >> shift) & byte_mask).to_bytes(8 * _LCG_LANES, "little")[::8])
+            packed = (packed * jump_a + jump_c) & state_mask
+        return b"".join(chunks)[:length], self.advance(x, length)
+
+    def _get_lanes(self):
+        if self._lanes is None:
+            # Lane i starts at x * a^i + c * (1 + a + ... + a^(i - 1)), so keep both coefficients per lane.
+            lane_a: list[int] = []
+            lane_c: list[int] = []
+            mul = 1
+            add = 0
+            for i in range(_LCG_LANES):
+                lane_a.append(mul)
+                lane_c.append(add)
+                mul = (mul * self.a) & 0xFFFFFFFF
+                add = (add * self.a + self.c) & 0xFFFFFFFF
+            self._lanes = (
+                int.from_bytes(struct.pack(f"<{_LCG_LANES}Q", *lane_a), "little"),
+                int.from_bytes(struct.pack(f"<{_LCG_LANES}Q", *lane_c), "little"),
+                mul,
+                add * _LANE_ONES,
+                0xFFFFFFFF * _LANE_ONES,
+                0xFF * _LANE_ONES,
+            )
+        return self._lanes
+
+    def _get_cycle(self):
+        if self._cycle is None:
+            shift = self.shift
+            period = 1 << (shift + 8)
+            mask = period - 1
+            cycle = bytearray(period)
+            position = array.array("I", bytes(4 * period))
+            x = 0
+            # All LCG parameters here satisfy the Hull-Dobell theorem, so every state is visited once per period.
+            for i in range(period):
+                position[x] = i
+                cycle[i] = (x >> shift) & 0xFF
+                x = (x * self.a + self.c) & mask
+            self._cycle = (bytes(cycle), position)
+        return self._cycle
 
 
 _V4_LCG_PARAM = [
@@ -54,6 +183,19 @@ _V4_LCG_PARAM = [
 ]
 
 
+def _v2_states(update_key: int, count: int) -> list[int]:
+    # libhonoka steps x -> x * 16807 mod (2^31 - 1), but only reduces the sum when its larger term alone exceeds the
+    # modulus, so some states are left as 2^31 - 1 + w instead of w. Fully reducing gives the same keys: such w is below
+    # 2^15, so its key bits are the same, and both map to 16807 * w next. 2^31 - 1 itself never changes in libhonoka.
+    states = [update_key] * count
+    if update_key == 0x7FFFFFFF:
+        return states
+    for i in range(1, count):
+        update_key = (update_key * 16807) % 0x7FFFFFFF
+        states[i] = update_key
+    return states
+
+
 class DecrypterContext:
     # Contains the header size of this particular decrypter context.
     HEADER_SIZE: ClassVar[int] = cast(int, 0)
@@ -61,6 +203,30 @@ class DecrypterContext:
     # Contains the crypt version number for this context.
     VERSION: ClassVar[int] = cast(int, 0)
 
+    @classmethod
+    def header_matches(
+        cls,
+        prefix: bytes,
+        filename: bytes,
+        key_tables: Sequence[int] | None = None,
+        header: bytes = b"",
+    ) -> bool:
+        """Cheaply check if the file header belongs to this context, without constructing it.
+
+        Args:
+            prefix (bytes): Game file prefix. Can be one of `NAME_PREFIX_*`
+            filename (bytes): Name of the file. The basename is used to derive the key.
+            key_tables (Sequence[int] | None, optional): Key tables with 64 elements. Defaults to None.
+            header (bytes, optional): First 16 bytes of the file contents. Defaults to empty bytes.
+
+        Raises:
+            NotImplementedError: Raised when the context has no header to check.
+
+        Returns:
+            bool: Whetever constructing the context with the same arguments is expected to succeed.
+        """
+        raise NotImplementedError("Please derive")
+
     def decrypt_int(self, data: int) -> int:
         """Decrypt single byte represented as int.
 
@@ -70,7 +236,7 @@ class DecrypterContext:
         Returns:
             int: Decrypted byte as int.
         """
-        raise NotImplementedError("Please derive")
+        return (data & 0xFF) ^ self._keystream(1)[0]
 
     def goto_offset(self, pos: int) -> None:
         """Recalculate decrypter context to decrypt at specified position in the file stream.
@@ -83,16 +249,25 @@ class DecrypterContext:
         """
         raise NotImplementedError("Please derive")
 
-    def decrypt_block(self, data: bytes) -> bytes:
+    def decrypt_block(self, data: bytes | bytearray | memoryview) -> bytes:
         """Decrypt bytes of data and return new bytes from it.
 
         Args:
-            data (bytes): Data to decrypt.
+            data (bytes | bytearray | memoryview): Data to decrypt.
 
         Returns:
             bytes: Decrypted data.
         """
-        return bytes(map(self.decrypt_int, data))
+        length = len(data)
+        if length <= _CHUNK_SIZE:
+            return xor_bytes(data, self._keystream(length))
+        # Keystream and XOR operands are as large as their input, so decrypt big inputs one chunk at a time.
+        view = memoryview(data)
+        chunks: list[bytes] = []
+        for pos in range(0, length, _CHUNK_SIZE):
+            chunk = view[pos : pos + _CHUNK_SIZE]
+            chunks.append(xor_bytes(chunk, self._keystream(len(chunk))))
+        return b"".join(chunks)
 
     def emit_header(self) -> bytes:
         """Print out the file header that identify the encryption mode.
@@ -102,12 +277,27 @@ class DecrypterContext:
         """
         return b""
 
+    def _keystream(self, length: int) -> bytes:
+        """Generate the next bytes of the XOR keystream, advancing the context.
+
+        Args:
+            length (int): Amount of keystream bytes to generate.
+
+        Returns:
+            bytes: Keystream to XOR the data with.
+        """
+        raise NotImplementedError("Please derive")
+
 
 class Version1Context(DecrypterContext):
     VERSION: ClassVar[int] = 1
 
     def __init__(
-        self, prefix: bytes, filename: bytes, key_tables: list[int] | None = None, header_test: bytes | None = None
+        self,
+        prefix: bytes,
+        filename: bytes,
+        key_tables: Sequence[int] | None = None,
+        header_test: bytes | None = None,
     ):
         digest, basename = calculate_md5(prefix, filename)
         self.update_key = (len(basename) & 0x3F) + 1
@@ -115,40 +305,41 @@ class Version1Context(DecrypterContext):
         self.xor_key = self.init_key
         self.pos = 0
 
-    def decrypt_int(self, data: int) -> int:
-        # Same key used to decrypt 4 bytes at a time, from msb to lsb.
-        index = self.pos & 3
-        key = (self.xor_key >> (3 - index) * 8) & 0xFF
-        result = data ^ key
-        if index == 3:
-            self._step()
-        self.pos = self.pos + 1
-        return result
-
     def goto_offset(self, pos: int):
         # Is it bounded?
         pos = max(pos, 0)
-        currentpos4 = self.pos // 4
-        newpos4 = pos // 4
-        if currentpos4 == newpos4:
-            # Only set pos
-            self.pos = pos
-            return
-        # Is it forward?
-        if newpos4 > currentpos4:
-            for i in range(currentpos4, newpos4):
-                self._step()
-            self.pos = pos
-            return
-        # TODO: Check if it's worth starting from beginning
-        # Start from beginning
-        self.xor_key = self.init_key
-        for i in range(newpos4):
-            self._step()
+        # Key only advances by a constant every 4 bytes, so any position can be computed directly.
+        self.xor_key = (self.init_key + (pos // 4) * self.update_key) & 0xFFFFFFFF
         self.pos = pos
 
-    def _step(self):
-        self.xor_key = (self.xor_key + self.update_key) & 0xFFFFFFFF
+    def _keystream(self, length: int) -> bytes:
+        # Same key used to decrypt 4 bytes at a time, from msb to lsb.
+        index = self.pos & 3
+        steps = (index + length) // 4
+        count = (index + length + 3) // 4
+        xor_key = self.xor_key
+        update_key = self.update_key
+        self.xor_key = (xor_key + steps * update_key) & 0xFFFFFFFF
+        self.pos = self.pos + length
+        if count < _V1_LANES_MIN_COUNT:
+            keys = [(xor_key + i * update_key) & 0xFFFFFFFF for i in range(count)]
+            return struct.pack(f">{count}I", *keys)[index : index + length]
+
+        # Compute keys of 1024 groups at once in 64-bit slots, then gather each slot's low 4 bytes most significant
+        # byte first. Slots hold at most a 32-bit key plus 1023 * 64, so they never carry into each other.
+        rounds = (count + _LCG_LANES - 1) // _LCG_LANES
+        steps_packed = update_key * _V1_LANE_INDEX
+        stream = bytearray(4 * _LCG_LANES * rounds)
+        view = memoryview(stream)
+        for i in range(rounds):
+            keys = ((xor_key * _LANE_ONES + steps_packed) & _V1_LANE_MASK).to_bytes(8 * _LCG_LANES, "little")
+            chunk = view[4 * _LCG_LANES * i : 4 * _LCG_LANES * (i + 1)]
+            chunk[0::4] = keys[3::8]
+            chunk[1::4] = keys[2::8]
+            chunk[2::4] = keys[1::8]
+            chunk[3::4] = keys[0::8]
+            xor_key = (xor_key + _LCG_LANES * update_key) & 0xFFFFFFFF
+        return bytes(view[index : index + length])
 
 
 class Version2Context(DecrypterContext):
@@ -156,7 +347,11 @@ class Version2Context(DecrypterContext):
     VERSION: ClassVar[int] = 2
 
     def __init__(
-        self, prefix: bytes, filename: bytes, key_tables: list[int] | None = None, header_test: bytes | None = None
+        self,
+        prefix: bytes,
+        filename: bytes,
+        key_tables: Sequence[int] | None = None,
+        header_test: bytes | None = None,
     ):
         digest, basename = calculate_md5(prefix, filename)
         if header_test is not None and digest[4:8] != header_test[:4]:
@@ -167,47 +362,55 @@ class Version2Context(DecrypterContext):
         self.update_key = self.init_key
         self.pos = 0
 
-    def decrypt_int(self, data: int) -> int:
-        # Same key used to decrypt 2 bytes at a time, from lsb to msb.
-        index = self.pos & 1
-        key = (self.xor_key >> index * 8) & 0xFF
-        result = data ^ key
-        if index == 1:
-            self._step()
-        self.pos = self.pos + 1
-        return result
+    @classmethod
+    def header_matches(
+        cls,
+        prefix: bytes,
+        filename: bytes,
+        key_tables: Sequence[int] | None = None,
+        header: bytes = b"",
+    ) -> bool:
+        if len(header) < cls.HEADER_SIZE:
+            return False
+        digest, _ = calculate_md5(prefix, filename)
+        return digest[4:8] == header[:4]
 
     def goto_offset(self, pos: int):
         # Is it bounded?
         pos = max(pos, 0)
         currentpos2 = self.pos // 2
         newpos2 = pos // 2
-        if currentpos2 == newpos2:
-            # Only set pos
-            self.pos = pos
-            return
-        # Is it forward?
-        if newpos2 > currentpos2:
-            for i in range(currentpos2, newpos2):
-                self._step()
-            self.pos = pos
-            return
-        # TODO: Check if it's worth starting from beginning
-        # Start from beginning
-        self.xor_key = ((self.init_key >> 23) & 0xFF) | ((self.init_key >> 7) & 0xFF00)
-        for i in range(newpos2):
-            self._step()
+        if newpos2 != currentpos2 and self.init_key != 0x7FFFFFFF:
+            # Key after n steps is init_key * 16807^n, so any position can be computed directly.
+            self.update_key = (self.init_key * pow(16807, newpos2, 0x7FFFFFFF)) % 0x7FFFFFFF
+        self.xor_key = ((self.update_key >> 23) & 0xFF) | ((self.update_key >> 7) & 0xFF00)
         self.pos = pos
 
-    def _step(self):
-        a = self.update_key >> 16
-        b = ((a * 0x41A70000) & 0x7FFFFFFF + (self.update_key & 0xFFFF) * 0x41A7) & 0xFFFFFFFF
-        c = ((a * 0x41A7) >> 15) & 0xFFFFFFFF
-        d = c + b
-        e = (d - 0x7FFFFFFF) % 0x100000000
-        f = e if e > 0x7FFFFFFE else d
-        self.update_key = f
-        self.xor_key = ((f >> 23) & 0xFF) | ((f >> 7) & 0xFF00)
+    def _keystream(self, length: int) -> bytes:
+        # Same key used to decrypt 2 bytes at a time, from lsb to msb.
+        index = self.pos & 1
+        steps = (index + length) // 2
+        count = (index + length + 1) // 2
+        if count == 0:
+            return b""
+        update_key = self.update_key
+        last_key = update_key
+        stream = bytearray(2 * count)
+        for start in range(0, count, _V2_BATCH_STATES):
+            batch = min(count - start, _V2_BATCH_STATES)
+            # One extra state is the start of the next batch.
+            states = _v2_states(update_key, batch + 1)
+            update_key = states.pop()
+            last_key = states[-1]
+            # Key bytes are bits 23-30 then bits 15-22 of each state, which become whole bytes after shifting left once.
+            packed = int.from_bytes(struct.pack(f"<{batch}Q", *states), "little") << 1
+            shifted = packed.to_bytes(8 * batch + 1, "little")
+            stream[2 * start : 2 * (start + batch) : 2] = shifted[3::8][:batch]
+            stream[2 * start + 1 : 2 * (start + batch) : 2] = shifted[2::8][:batch]
+        self.update_key = last_key if count > steps else update_key
+        self.xor_key = ((self.update_key >> 23) & 0xFF) | ((self.update_key >> 7) & 0xFF00)
+        self.pos = self.pos + length
+        return bytes(memoryview(stream)[index : index + length])
 
     def emit_header(self) -> bytes:
         return self.header
@@ -219,25 +422,20 @@ class _V3Base(DecrypterContext):
     lcg: _LCGKeys
     init_key: int
 
-    def decrypt_int(self, data: int):
-        result = (data & 0xFF) ^ ((self.update_key >> (self.lcg.shift & 0x1F)) & 0xFF)
-        self.pos = self.pos + 1
-        self._step()
-        return result
+    def _keystream(self, length: int) -> bytes:
+        stream, self.update_key = self.lcg.keystream(self.update_key, length)
+        self.pos = self.pos + length
+        return stream
 
     def goto_offset(self, pos: int) -> None:
-        if self.pos >= pos:
-            loop = pos - self.pos
+        # Is it bounded?
+        pos = max(pos, 0)
+        if pos >= self.pos:
+            self.update_key = self.lcg.advance(self.update_key, pos - self.pos)
         else:
-            self.update_key = self.init_key
-            loop = pos
-        for i in range(loop):
-            self._step()
+            self.update_key = self.lcg.advance(self.init_key, pos)
         self.pos = pos
 
-    def _step(self):
-        self.update_key = self.lcg.next(self.update_key)
-
 
 class Version3Context(_V3Base):
     VERSION: ClassVar[int] = 3
@@ -247,7 +445,7 @@ class Version3Context(_V3Base):
         prefix: bytes,
         md5digest: bytes,
         basename: bytes,
-        key_tables: list[int],
+        key_tables: Sequence[int],
         enforce_ns: bool = True,
         *,
         flip: bool = False,
@@ -271,25 +469,13 @@ class Version3Context(_V3Base):
         self.md5 = md5digest
 
     def emit_header(self) -> bytes:
-        return bytes(
-            [
-                (~self.md5[4]) & 0xFF,
-                (~self.md5[5]) & 0xFF,
-                (~self.md5[6]) & 0xFF,
-                12,
-                0,
-                0,
-                0,
-                int(self.flipped),
-                (self.name_sum >> 24) & 0xFF,
-                (self.name_sum >> 16) & 0xFF,
-                (self.name_sum >> 8) & 0xFF,
-                self.name_sum & 0xFF,
-                0,
-                0,
-                0,
-                0,
-            ]
+        return _V3_HEADER.pack(
+            (~self.md5[4]) & 0xFF,
+            (~self.md5[5]) & 0xFF,
+            (~self.md5[6]) & 0xFF,
+            12,
+            int(self.flipped),
+            self.name_sum & 0xFFFFFFFF,
         )
 
 
@@ -309,25 +495,8 @@ class Version4Context(_V3Base):
         self.md5 = md5hash
 
     def emit_header(self) -> bytes:
-        return bytes(
-            [
-                (~self.md5[4]) & 0xFF,
-                (~self.md5[5]) & 0xFF,
-                (~self.md5[6]) & 0xFF,
-                12,
-                0,
-                0,
-                self.lcg_index,
-                2,
-                0,
-                0,
-                0,
-                0,
-                0,
-                0,
-                0,
-                0,
-            ]
+        return _V4_HEADER.pack(
+            (~self.md5[4]) & 0xFF, (~self.md5[5]) & 0xFF, (~self.md5[6]) & 0xFF, 12, self.lcg_index, 2
         )
 
 
@@ -339,10 +508,34 @@ def _test_v3(header: bytes | None, md5hash: bytes):
             raise InvalidHeaderError("3+")
 
 
+def header_matches_v3(
+    prefix: bytes, filename: bytes, key_tables: Sequence[int] | None = None, header: bytes = b""
+) -> bool:
+    """Cheaply check if the file header belongs to Version 3+ game files, without setting up the context.
+
+    Args:
+        prefix (bytes): Game file prefix. Can be one of `NAME_PREFIX_*`
+        filename (bytes): Name of the file. The basename is used to derive the key.
+        key_tables (Sequence[int] | None, optional): Key tables with 64 elements used for V3 decryption. Defaults to None.
+        header (bytes, optional): First 16 bytes of the file contents. Defaults to empty bytes.
+
+    Returns:
+        bool: Whetever `setup_v3` with the same arguments is expected to succeed.
+    """
+    if len(header) < _V3Base.HEADER_SIZE:
+        return False
+    digest, _ = calculate_md5(prefix, filename)
+    if header[0] != (~digest[4] & 255) or header[1] != (~digest[5] & 255) or header[2] != (~digest[6] & 255):
+        return False
+    if header[7] < 2:
+        return key_tables is not None
+    return header[7] == 2
+
+
 def setup_v3(
     prefix: bytes,
     filename: bytes,
-    key_tables: list[int] | None = None,
+    key_tables: Sequence[int] | None = None,
     header_test: bytes | None = None,
     *,
     version: int = 0,
@@ -355,7 +548,7 @@ def setup_v3(
     Args:
         prefix (bytes): Game file prefix. Can be one of `NAME_PREFIX_*`
         filename (bytes): Name of the file. The basename is used to derive the key.
-        key_tables (list[int] | None, optional): Key tables with 64 elements used for V3 decryption. Can be one of `KEY_TABLES_*`. Defaults to None.
+        key_tables (Sequence[int] | None, optional): Key tables with 64 elements used for V3 decryption. Can be one of `KEY_TABLES_*`. Defaults to None.
         header_test (bytes | None, optional): When decrypting, first 16 bytes of the file contents. Defaults to None which means encryption is assumed.
         version (int, optional): Decrypt/encrypt version. Must be 0 or at least 3 or more. Defaults to 0.
         flip_v3 (bool, optional): Whetever to flip the initial key in V3. Defaults to False.
@@ -20,8 +20,14 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+from typing import Final
+
+
+__all__ = ["KEY_TABLES_JP", "KEY_TABLES_WW", "KEY_TABLES_EN", "KEY_TABLES_TW", "KEY_TABLES_CN"]
+
+
 # SIF JP/SIF WW post-merge version 3 key tables
-KEY_TABLES_JP = [
+KEY_TABLES_JP: Final[tuple[int, ...]] = (
     1210253353,
     1736710334,
     1030507233,
@@ -86,11 +92,11 @@ KEY_TABLES_JP = [
     1221338057,
     1623152467,
     1020681319,
-]
+)
 assert len(KEY_TABLES_JP) == 64
 
 # SIF WW (pre-merge to JP) version 3 key tables
-KEY_TABLES_WW = [
+KEY_TABLES_WW: Final[tuple[int, ...]] = (
     2861607190,
     3623207331,
     3775582911,
@@ -155,12 +161,12 @@ KEY_TABLES_WW = [
     3316646782,
     322755307,
     3531653795,
-]
-KEY_TABLES_EN = KEY_TABLES_WW
+)
+KEY_TABLES_EN: Final[tuple[int, ...]] = KEY_TABLES_WW
 assert len(KEY_TABLES_WW) == 64
 
 # SIF TW (pre-merge to WW) version 3 key tables
-KEY_TABLES_TW = [
+KEY_TABLES_TW: Final[tuple[int, ...]] = (
     0xA925E518,
     0x5AB9C4A4,
     0x01950558,
@@ -225,11 +231,11 @@ KEY_TABLES_TW = [
     0x49A7FAD6,
     0x7BEDDD15,
     0xC6913CED,
-]
+)
 assert len(KEY_TABLES_TW) == 64
 
 # SIF CN version 3 key tables
-KEY_TABLES_CN = [
+KEY_TABLES_CN: Final[tuple[int, ...]] = (
     0x1B695658,
     0x0A43A213,
     0x0EAD0863,
@@ -294,5 +300,5 @@ KEY_TABLES_CN = [
     0xA0290F82,
     0xD3E95AFC,
     0x9C6A97B4,
-]
+)
 assert len(KEY_TABLES_CN) == 64
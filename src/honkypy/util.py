@@ -20,12 +20,30 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import functools
 import hashlib
 import os
 
+# Amount of data decrypted at a time, so memory use stays bounded for large inputs.
+_CHUNK_SIZE = 1 << 20
 
+
+@functools.lru_cache(maxsize=16)
+def _prefix_md5(prefix: bytes):
+    # There are only a handful of game prefixes, so keep their absorbed MD5 state around.
+    return hashlib.md5(prefix, usedforsecurity=False)
+
+
+# Probing a file derives the key from the same prefix and filename once per candidate context.
+@functools.lru_cache(maxsize=4096)
 def calculate_md5(prefix: bytes, filename: bytes):
     basename = os.path.basename(filename)
-    md5 = hashlib.md5(prefix, usedforsecurity=False)
+    md5 = _prefix_md5(prefix).copy()
     md5.update(basename)
     return md5.digest(), basename
+
+
+def xor_bytes(data: bytes | bytearray | memoryview, key: bytes | bytearray | memoryview) -> bytes:
+    """XOR two equally-sized buffers in one go using CPython's arbitrary-precision integers."""
+    length = len(data)
+    return (int.from_bytes(data, "little") ^ int.from_bytes(key, "little")).to_bytes(length, "little")
@@ -0,0 +1,76 @@
+# Honky Pie, a HonokaMiku/libhonoka implementation in Python
+#
+# Copyright (c) 2023 Dark Energy Processor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import unittest
+
+import honkypy
+
+
+# Keystream of the libhonoka version 2 decrypter, compiled with native uint32_t arithmetic, for this JP file. Within
+# these 300 KiB it passes twice through a state libhonoka leaves unreduced, above 2^31 - 1.
+FILENAME = b"assets/image/unit/u_normal_2.png"
+HEADER = bytes.fromhex("61b9083b")
+LENGTH = 300 * 1024
+KEYSTREAM_HEAD = bytes.fromhex("9201a1bf210dffec1c8c42ea120a549e")
+KEYSTREAM_SHA256 = "a8a30b9ac227bb8f5b18306b3e089512f83c9c01092f4a01e73241e51452fc5a"
+
+
+class Version2Test(unittest.TestCase):
+    def test_header(self):
+        dctx = honkypy.encrypt_setup_by_gametype("JP", FILENAME, 2)
+        self.assertEqual(dctx.emit_header(), HEADER)
+
+    def test_probe(self):
+        dctx, gametype = honkypy.decrypt_setup_probe(FILENAME, HEADER + bytes(12))
+        self.assertEqual((dctx.VERSION, gametype), (2, "JP"))
+
+    def test_keystream(self):
+        dctx = honkypy.encrypt_setup_by_gametype("JP", FILENAME, 2)
+        keystream = dctx.decrypt_block(bytes(LENGTH))
+        self.assertEqual(keystream[:16], KEYSTREAM_HEAD)
+        self.assertEqual(hashlib.sha256(keystream).hexdigest(), KEYSTREAM_SHA256)
+
+    def test_keystream_odd_chunks(self):
+        dctx = honkypy.encrypt_setup_by_gametype("JP", FILENAME, 2)
+        keystream = b"".join(dctx.decrypt_block(bytes(4099)) for _ in range(0, LENGTH, 4099))[:LENGTH]
+        self.assertEqual(hashlib.sha256(keystream).hexdigest(), KEYSTREAM_SHA256)
+
+    def test_seek(self):
+        dctx = honkypy.encrypt_setup_by_gametype("JP", FILENAME, 2)
+        keystream = dctx.decrypt_block(bytes(LENGTH))
+        for pos in (0, 1, 2, 12345, 131071, LENGTH - 3):
+            dctx.goto_offset(pos)
+            self.assertEqual(dctx.decrypt_block(bytes(LENGTH - pos)), keystream[pos:], pos)
+
+    def test_fixed_point(self):
+        # libhonoka never leaves state 2^31 - 1, so its keystream is all ones from there.
+        dctx = honkypy.encrypt_setup_by_gametype("JP", FILENAME, 2)
+        dctx.init_key = dctx.update_key = 0x7FFFFFFF
+        dctx.goto_offset(0)
+        self.assertEqual(dctx.decrypt_block(bytes(8)), b"\xff" * 8)
+        dctx.goto_offset(1001)
+        self.assertEqual(dctx.decrypt_block(bytes(5)), b"\xff" * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()